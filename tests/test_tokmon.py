@@ -1,13 +1,469 @@
+import asyncio
+import contextlib
+import glob
+import io
+import json
+import os
+import re
+import tempfile
+import time
 import unittest
+from typing import Dict
+
+from mitmproxy import http, io as mitmproxy_io
+from mitmproxy.test import tflow
+
+from tokmon.cli import replay_cli
+from tokmon.common import calculate_usage_cost, load_pricing
+from tokmon.costcalculator import CostCalculator, CostTracker
+from tokmon.inprocess import InProcessMonitor, observe_exchange
+from tokmon.live import LiveReporter
+from tokmon.messagestore import MessageStore
+from tokmon.recorder import UsageRecorder
+from tokmon.replay import iter_exchanges, replay_exchanges
+from tokmon.responsecache import ResponseCache
+from tokmon.tokmon import TokenMonitor
+from tokmon.utils import compile_target_matcher, allow_hosts_for_targets
+
+PRICING = {
+    "gpt-4": {"prompt_cost": 0.03, "completion_cost": 0.06, "per_tokens": 1000},
+    "text-davinci-003": {"cost": 0.02, "per_tokens": 1000},
+}
+
+def make_exchange(prompt: str, completion: str, prompt_tokens: int = 10, completion_tokens: int = 5, model: str = "gpt-4", cached: bool = False):
+    request = {"model": model, "messages": [{"role": "user", "content": prompt}]}
+    response = {
+        "model": model,
+        "messages": [{"role": "assistant", "content": completion}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    }
+    if cached:
+        response["cached"] = True
+    return request, response
+
+class TestTargetMatching(unittest.TestCase):
+    def test_matcher_matches_any_target_prefix(self):
+        matcher = compile_target_matcher(["https://api.openai.com", "https://gw.internal:8443/v1"])
+        self.assertIsNotNone(matcher.match("https://api.openai.com/v1/chat/completions"))
+        self.assertIsNotNone(matcher.match("https://gw.internal:8443/v1/chat/completions"))
+        self.assertIsNone(matcher.match("https://gw.internal/v1/chat/completions"))
+        self.assertIsNone(matcher.match("https://s3.amazonaws.com/bucket/artifact"))
+
+    def test_allow_hosts_match_bare_hostnames(self):
+        patterns = allow_hosts_for_targets(["https://api.openai.com", "https://gw.internal:8443/v1", "https://api.openai.com/v2"])
+        self.assertEqual(len(patterns), 2)
+        # mitmproxy checks allow_hosts against hostnames without a port
+        self.assertTrue(any(re.search(p, "gw.internal") for p in patterns))
+        self.assertTrue(any(re.search(p, "api.openai.com") for p in patterns))
+        self.assertFalse(any(re.search(p, "s3.amazonaws.com") for p in patterns))
+
+    def test_allow_hosts_rejects_bare_host(self):
+        with self.assertRaises(ValueError):
+            allow_hosts_for_targets(["api.openai.com"])
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_key_is_canonical(self):
+        url = "https://api.openai.com/v1/chat/completions"
+        a = ResponseCache.key_for(url, {"model": "gpt-4", "temperature": 0, "messages": []})
+        b = ResponseCache.key_for(url, {"messages": [], "temperature": 0, "model": "gpt-4"})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, ResponseCache.key_for("https://gw.internal/v1/chat/completions", {"model": "gpt-4", "temperature": 0, "messages": []}))
+        self.assertNotEqual(a, ResponseCache.key_for(url, {"model": "gpt-4", "temperature": 0, "messages": [], "stream": True}))
+
+    def test_only_deterministic_requests_are_cacheable(self):
+        self.assertTrue(ResponseCache.is_cacheable({"temperature": 0}))
+        self.assertFalse(ResponseCache.is_cacheable({}))
+        self.assertFalse(ResponseCache.is_cacheable({"temperature": 0.7}))
+        self.assertFalse(ResponseCache.is_cacheable({"temperature": 0, "n": 2}))
+
+    def test_round_trip_keeps_body_and_drops_transfer_headers(self):
+        cache = ResponseCache(self.cache_dir)
+        body = b"data: {}\n\ndata: [DONE]\n\n"
+        cache.put("k", 200, {"Content-Type": "text/event-stream", "Content-Length": "3"}, body)
+        entry = cache.get("k")
+        self.assertEqual(entry["content"], body)
+        self.assertEqual(entry["headers"], {"Content-Type": "text/event-stream"})
+        self.assertIsNone(cache.get("missing"))
+
+    def test_expired_entries_are_removed(self):
+        cache = ResponseCache(self.cache_dir, ttl_seconds=0.01)
+        cache.put("k", 200, {}, b"x")
+        time.sleep(0.05)
+        self.assertIsNone(cache.get("k"))
+        self.assertFalse(os.path.exists(cache.path_for("k")))
+        self.assertEqual(cache.total_bytes, 0)
+
+    def test_eviction_is_least_recently_used(self):
+        cache = ResponseCache(self.cache_dir)
+        for i, key in enumerate(["a", "b", "c"]):
+            cache.put(key, 200, {}, b"x" * 100)
+            os.utime(cache.path_for(key), (1000 + i, 1000 + i))
+        entry_size = os.path.getsize(cache.path_for("a"))
+
+        # Reading "a" makes "b" the least recently used entry
+        self.assertIsNotNone(cache.get("a"))
+        cache.max_bytes = int(entry_size * 3.5)
+        cache.put("d", 200, {}, b"x" * 100)
+
+        self.assertIsNone(cache.get("b"))
+        for key in ["a", "c", "d"]:
+            self.assertIsNotNone(cache.get(key))
+        self.assertLessEqual(cache.total_bytes, cache.max_bytes)
+
+    def test_size_estimate_survives_restart(self):
+        cache = ResponseCache(self.cache_dir)
+        cache.put("a", 200, {}, b"x" * 100)
+        cache.put("a", 200, {}, b"x" * 100)
+        self.assertEqual(ResponseCache(self.cache_dir).total_bytes, cache.total_bytes)
+
+class TestCostCalculator(unittest.TestCase):
+    def test_calculate_cost(self):
+        summary = CostCalculator(PRICING).calculate_cost("conversation", [
+            make_exchange("hello", "hi", prompt_tokens=1000, completion_tokens=1000),
+            make_exchange("hello", "hi", prompt_tokens=500, completion_tokens=500, model="text-davinci-003"),
+        ])
+        self.assertAlmostEqual(summary["total_cost"], 0.03 + 0.06 + 0.02)
+        self.assertEqual(summary["total_usage"]["total_tokens"], 3000)
+        self.assertEqual(sorted(summary["models"]), ["gpt-4", "text-davinci-003"])
+        self.assertEqual(len(summary["raw_data"]), 2)
+        self.assertNotIn("cache", summary)
+
+    def test_cache_hits_are_not_billed(self):
+        summary = CostCalculator(PRICING).calculate_cost("conversation", [
+            make_exchange("hello", "hi", prompt_tokens=1000, completion_tokens=1000),
+            make_exchange("hello", "hi", prompt_tokens=1000, completion_tokens=1000, cached=True),
+        ])
+        self.assertAlmostEqual(summary["total_cost"], 0.09)
+        self.assertEqual(summary["total_usage"]["total_tokens"], 2000)
+        self.assertEqual(summary["cache"]["hits"], 1)
+        self.assertAlmostEqual(summary["cache"]["avoided_cost"], 0.09)
+        self.assertEqual(summary["cache"]["avoided_tokens"], 2000)
+        self.assertTrue(summary["raw_data"][1]["cached"])
+
+class TestCompactSummary(unittest.TestCase):
+    def conversation(self):
+        system = {"role": "system", "content": "You're a helpful assistant."}
+        first_user = {"role": "user", "content": "hello"}
+        first_reply = {"role": "assistant", "content": "hi"}
+        second_user = {"role": "user", "content": "how are you?"}
+        second_reply = {"role": "assistant", "content": "great"}
+        usage = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+        return [
+            ({"messages": [system, first_user]}, {"model": "gpt-4", "messages": [first_reply], "usage": usage}),
+            # Later turns re-send the history as equal (but distinct) dicts, as the API clients do
+            ({"messages": [dict(system), dict(first_user), dict(first_reply), second_user]}, {"model": "gpt-4", "messages": [second_reply], "usage": usage}),
+        ]
+
+    def test_compact_sends_only_new_messages(self):
+        summary = CostCalculator(PRICING, compact=True).calculate_cost("conversation", self.conversation())
+        first, second = summary["raw_data"]
+
+        self.assertNotIn("messages", first)
+        self.assertEqual(len(first["message_refs"]), 3)
+        self.assertEqual(list(first["new_messages"].keys()), first["message_refs"])
+
+        self.assertEqual(len(second["message_refs"]), 5)
+        self.assertEqual(second["message_refs"][:3], first["message_refs"])
+        self.assertEqual(list(second["new_messages"].values()), [{"role": "user", "content": "how are you?"}, {"role": "assistant", "content": "great"}])
+
+    def test_compact_round_trips_to_full_messages(self):
+        full = CostCalculator(PRICING).calculate_cost("conversation", self.conversation())
+        compact = CostCalculator(PRICING, compact=True).calculate_cost("conversation", self.conversation())
+
+        messages_by_ref = {}
+        for full_round_trip, compact_round_trip in zip(full["raw_data"], compact["raw_data"]):
+            messages_by_ref.update(compact_round_trip["new_messages"])
+            self.assertEqual([messages_by_ref[ref] for ref in compact_round_trip["message_refs"]], full_round_trip["messages"])
+        self.assertAlmostEqual(full["total_cost"], compact["total_cost"])
+
+    def test_message_store_interns_equal_messages(self):
+        store = MessageStore()
+        message = {"role": "user", "content": "hello"}
+        self.assertIs(store.intern(dict(message)), store.intern(dict(message)))
+        self.assertEqual(store.ref(message), store.ref(dict(message)))
+        self.assertNotEqual(store.ref(message), store.ref({"role": "user", "content": "bye"}))
+
+    def test_build_exchange_can_skip_interning(self):
+        recorder = UsageRecorder("https://api.openai.com")
+        recorder.build_exchange(json.loads(CHAT_REQUEST), CHAT_RESPONSE, False, intern=False)
+        self.assertEqual(recorder.message_store.messages, {})
+
+        request, response = recorder.build_exchange(json.loads(CHAT_REQUEST), CHAT_RESPONSE, False)
+        self.assertEqual(len(recorder.message_store.messages), 2)
+        self.assertIs(request["messages"][0], recorder.message_store.intern({"role": "user", "content": "hello"}))
+
+class TestCostTracker(unittest.TestCase):
+    def test_running_totals_match_full_calculation(self):
+        calculator = CostCalculator(PRICING)
+        tracker = CostTracker(calculator)
+        exchanges = [
+            make_exchange("a", "b", prompt_tokens=1000, completion_tokens=1000),
+            make_exchange("c", "d", prompt_tokens=500, completion_tokens=500, model="text-davinci-003"),
+            make_exchange("a", "b", prompt_tokens=1000, completion_tokens=1000, cached=True),
+            make_exchange("e", "f", prompt_tokens=100, completion_tokens=200),
+        ]
+        for _, response in exchanges:
+            tracker.add(response)
+
+        running = tracker.summary("conversation")
+        full = calculator.calculate_cost("conversation", exchanges)
+        self.assertAlmostEqual(running["total_cost"], full["total_cost"])
+        self.assertEqual(running["total_usage"], full["total_usage"])
+        self.assertEqual(running["cache"]["hits"], full["cache"]["hits"])
+        self.assertAlmostEqual(running["cache"]["avoided_cost"], full["cache"]["avoided_cost"])
+        self.assertEqual(tracker.requests, 3)
+        self.assertEqual(running["per_model"]["gpt-4"]["requests"], 2)
+        self.assertEqual(running["per_model"]["gpt-4"]["total_tokens"], 2300)
+        self.assertAlmostEqual(running["per_model"]["text-davinci-003"]["cost"], 0.02)
+
+    def test_budget_exceeded(self):
+        self.assertFalse(CostTracker(CostCalculator(PRICING)).budget_exceeded())
+        self.assertTrue(CostTracker(CostCalculator(PRICING), budget=0).budget_exceeded())
+
+        tracker = CostTracker(CostCalculator(PRICING), budget=0.1)
+        tracker.add(make_exchange("a", "b", prompt_tokens=1000, completion_tokens=1000)[1])
+        self.assertFalse(tracker.budget_exceeded())
+
+        # Cache hits aren't billed, so they don't count toward the budget
+        tracker.add(make_exchange("a", "b", prompt_tokens=1000, completion_tokens=1000, cached=True)[1])
+        self.assertFalse(tracker.budget_exceeded())
+
+        tracker.add(make_exchange("c", "d", prompt_tokens=1000, completion_tokens=1000)[1])
+        self.assertTrue(tracker.budget_exceeded())
+
+    def test_unpriced_models_are_tracked_at_zero_cost(self):
+        tracker = CostTracker(CostCalculator(PRICING))
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            tracker.add(make_exchange("a", "b", model="gpt-3.5-turbo-0613")[1])
+            tracker.add(make_exchange("c", "d", model="gpt-3.5-turbo-0613")[1])
+        tracker.add(make_exchange("e", "f")[1])
+
+        summary = tracker.summary("conversation")
+        self.assertEqual(output.getvalue().count("no pricing data"), 1)
+        self.assertEqual(summary["per_model"]["gpt-3.5-turbo-0613"]["total_tokens"], 30)
+        self.assertEqual(summary["per_model"]["gpt-3.5-turbo-0613"]["cost"], 0.0)
+        self.assertEqual(summary["total_usage"]["total_tokens"], 45)
+        self.assertCountEqual(summary["models"], ["gpt-4", "gpt-3.5-turbo-0613"])
+
+class TestLiveReporter(unittest.TestCase):
+    def read_total_tokens(self, snapshot_path: str) -> int:
+        with open(snapshot_path) as f:
+            return json.load(f)["total_usage"]["total_tokens"]
+
+    def test_throttled_update_is_written_after_the_interval(self):
+        tracker = CostTracker(CostCalculator(PRICING))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, "snapshot.json")
+            reporter = LiveReporter(tracker, "conversation", 0.05, snapshot_path=snapshot_path)
+
+            tracker.add(make_exchange("a", "b")[1])
+            reporter.update()
+            tracker.add(make_exchange("c", "d")[1])
+            reporter.update()
+            # Within the interval: held back rather than dropped
+            self.assertEqual(self.read_total_tokens(snapshot_path), 15)
+            self.assertTrue(reporter.pending)
+
+            async def run_reporter():
+                task = asyncio.ensure_future(reporter.run())
+                await asyncio.sleep(0.2)
+                task.cancel()
+
+            asyncio.run(run_reporter())
+            self.assertEqual(self.read_total_tokens(snapshot_path), 30)
+            self.assertFalse(reporter.pending)
+
+CHAT_URL = "https://api.openai.com/v1/chat/completions"
+CHAT_REQUEST = json.dumps({"model": "gpt-4", "messages": [{"role": "user", "content": "hello"}]})
+CHAT_RESPONSE = json.dumps({
+    "model": "gpt-4",
+    "choices": [{"message": {"role": "assistant", "content": "hi"}}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+})
+
+class TestInProcessMonitor(unittest.TestCase):
+    def test_records_target_exchanges_only(self):
+        with InProcessMonitor(print_report=False) as monitor:
+            observe_exchange(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)
+            observe_exchange("https://s3.amazonaws.com/bucket/artifact", CHAT_REQUEST, CHAT_RESPONSE)
+        observe_exchange(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)
+
+        self.assertEqual(len(monitor.monitor.history), 1)
+        self.assertEqual(monitor.cost_summary()["total_usage"]["total_tokens"], 15)
+
+    def test_reentering_counts_exchanges_once(self):
+        monitor = InProcessMonitor(print_report=False)
+        with monitor:
+            with monitor:
+                observe_exchange(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)
+            # Still active until the outermost block exits
+            observe_exchange(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)
+        observe_exchange(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)
+
+        self.assertEqual(len(monitor.monitor.history), 2)
+
+    def test_recursive_decorated_function(self):
+        monitor = InProcessMonitor(print_report=False)
+
+        @monitor
+        def call_api(depth: int):
+            observe_exchange(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)
+            if depth > 0:
+                call_api(depth - 1)
+
+        call_api(2)
+        self.assertEqual(len(monitor.monitor.history), 3)
+        self.assertEqual(monitor.active_count, 0)
+
+def make_flow(request_body: str = CHAT_REQUEST, url: str = CHAT_URL) -> http.HTTPFlow:
+    return tflow.tflow(req=http.Request.make("POST", url, request_body, {"Content-Type": "application/json"}))
 
 class TestTokenMonitor(unittest.TestCase):
-    # Tests are needed!
-    # Examples:
-    #     - feed a request to handle_request and check that the usage_data is updated as expected
-    #     - feed a response to handle_response and check that the usage_data is updated as expected
-    #     - same as the above but for streaming
-    # ...
-    pass
+    def run_flow(self, monitor: TokenMonitor, flow: http.HTTPFlow, response_body: str = CHAT_RESPONSE) -> http.HTTPFlow:
+        """
+        Drive a flow through the proxy hooks; the upstream only answers if the request hook didn't
+        """
+        monitor.request(flow)
+        if flow.response is None:
+            flow.response = http.Response.make(200, response_body, {"Content-Type": "application/json"})
+        monitor.response(flow)
+        return flow
+
+    def test_unpriced_model_does_not_break_the_response_hook(self):
+        handled = []
+        monitor = TokenMonitor(CHAT_URL, "true",
+                               req_res_handler=lambda *exchange: handled.append(exchange),
+                               cost_tracker=CostTracker(CostCalculator(PRICING)))
+        response_body = CHAT_RESPONSE.replace('"gpt-4"', '"gpt-3.5-turbo-0613"')
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.run_flow(monitor, make_flow(), response_body)
+
+        self.assertEqual(len(handled), 1)
+        self.assertIsNone(monitor.current_request)
+        self.assertEqual(monitor.cost_tracker.total_tokens, 15)
+
+    def test_repeated_deterministic_request_is_served_from_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            monitor = TokenMonitor(CHAT_URL, "true",
+                                   response_cache=ResponseCache(cache_dir),
+                                   cost_tracker=CostTracker(CostCalculator(PRICING)))
+            request_body = json.dumps({**json.loads(CHAT_REQUEST), "temperature": 0})
+
+            miss = self.run_flow(monitor, make_flow(request_body))
+            self.assertNotIn("x-tokmon-cache", miss.response.headers)
+            self.assertEqual(monitor.response_cache.total_bytes, monitor.response_cache.scan()[0][1])
+
+            # The upstream answer of `run_flow` would be a different body; the cached one must win
+            hit = self.run_flow(monitor, make_flow(request_body), CHAT_RESPONSE.replace("hi", "upstream"))
+            self.assertEqual(hit.response.headers["x-tokmon-cache"], "HIT")
+            self.assertEqual(hit.response.text, CHAT_RESPONSE)
+
+        summary = calculate_usage_cost(monitor, monitor.cost_tracker.calculator)
+        self.assertEqual(summary["cache"]["hits"], 1)
+        self.assertEqual(summary["total_usage"]["total_tokens"], 15)
+
+    def test_requests_over_budget_are_blocked(self):
+        # The first exchange costs $0.0006, which is over budget
+        monitor = TokenMonitor(CHAT_URL, "true", cost_tracker=CostTracker(CostCalculator(PRICING), budget=0.0005))
+        with contextlib.redirect_stdout(io.StringIO()):
+            allowed = self.run_flow(monitor, make_flow())
+            blocked = [self.run_flow(monitor, make_flow()) for _ in range(2)]
+
+        self.assertEqual(allowed.response.status_code, 200)
+        self.assertEqual([flow.response.status_code for flow in blocked], [402, 402])
+        self.assertEqual(json.loads(blocked[0].response.text)["error"]["code"], "budget_exceeded")
+        self.assertEqual(monitor.blocked_requests, 2)
+        # Blocked flows are never accounted for
+        self.assertEqual(len(monitor.history), 1)
+        self.assertIsNone(monitor.current_request)
+
+def chat_response(content: str, prompt_tokens: int, completion_tokens: int) -> Dict:
+    return {
+        "model": "gpt-4",
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    }
+
+class TestReplay(unittest.TestCase):
+    # More exchanges than fit in one batch with two workers, so ordering across batches is exercised
+    EXCHANGE_COUNT = 300
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.capture_path = os.path.join(self.tmp_dir.name, "capture.jsonl")
+
+        # The expected history, in the format `UsageRecorder` builds
+        self.expected = []
+        with open(self.capture_path, "w") as f:
+            for i in range(self.EXCHANGE_COUNT):
+                request = {"model": "gpt-4", "messages": [{"role": "user", "content": f"prompt {i}"}]}
+                response = chat_response(f"completion {i}", 10 + i, 5 + i)
+                # The response is either the raw response text or the response JSON object
+                entry = {"url": CHAT_URL, "request": request, "response": json.dumps(response) if i % 2 else response}
+                f.write(json.dumps(entry) + "\n")
+                if i % 100 == 0:
+                    f.write("not json\n")
+                    f.write(json.dumps({"url": "https://s3.amazonaws.com/bucket/artifact", "request": "", "response": "binary"}) + "\n")
+                self.expected.append(make_exchange(f"prompt {i}", f"completion {i}", prompt_tokens=10 + i, completion_tokens=5 + i))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_jsonl_reader_skips_malformed_and_non_target_lines(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            exchanges = list(iter_exchanges([self.capture_path], [CHAT_URL]))
+
+        self.assertEqual(len(exchanges), self.EXCHANGE_COUNT)
+        self.assertEqual(output.getvalue().count("Skipping malformed exchange"), 3)
+        # Response objects are turned back into response text
+        self.assertEqual(json.loads(exchanges[0][2]), chat_response("completion 0", 10, 5))
+        self.assertEqual(exchanges[1][2], json.dumps(chat_response("completion 1", 11, 6)))
+        self.assertTrue(all(url == CHAT_URL for url, _, _ in exchanges))
+
+    def test_flow_reader_skips_non_target_flows(self):
+        flow_path = os.path.join(self.tmp_dir.name, "capture.flows")
+        with open(flow_path, "wb") as f:
+            writer = mitmproxy_io.FlowWriter(f)
+            for url in [CHAT_URL, "https://s3.amazonaws.com/bucket/artifact"]:
+                flow = make_flow(url=url)
+                flow.response = http.Response.make(200, CHAT_RESPONSE, {"Content-Type": "application/json"})
+                writer.add(flow)
+
+        exchanges = list(iter_exchanges([flow_path], [CHAT_URL]))
+        self.assertEqual(exchanges, [(CHAT_URL, CHAT_REQUEST, CHAT_RESPONSE)])
+
+    def test_replay_matches_calculate_cost(self):
+        calculator = CostCalculator(PRICING)
+        with contextlib.redirect_stdout(io.StringIO()):
+            history = replay_exchanges([self.capture_path], [CHAT_URL], MessageStore(), workers=2)
+
+        replayed = calculator.calculate_cost("conversation", history)
+        expected = calculator.calculate_cost("conversation", self.expected)
+        self.assertEqual(replayed["total_usage"], expected["total_usage"])
+        self.assertAlmostEqual(replayed["total_cost"], expected["total_cost"])
+        # Same round trips, in capture order
+        self.assertEqual(replayed["raw_data"], expected["raw_data"])
+
+    def test_replay_cli_writes_summary(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            replay_cli([self.capture_path, "--workers", "2", "--json_out", self.tmp_dir.name])
+
+        summary_paths = glob.glob(os.path.join(self.tmp_dir.name, "tokmon_usage_summary_*.json"))
+        self.assertEqual(len(summary_paths), 1)
+        with open(summary_paths[0]) as f:
+            summary = json.load(f)
+
+        expected = CostCalculator(load_pricing(None)).calculate_cost("conversation", self.expected)
+        self.assertEqual(summary["total_usage"], expected["total_usage"])
+        self.assertAlmostEqual(summary["total_cost"], expected["total_cost"])
+        self.assertEqual(len(summary["raw_data"]), self.EXCHANGE_COUNT)
 
 if __name__ == "__main__":
     unittest.main()
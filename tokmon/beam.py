@@ -1,14 +1,21 @@
 from enum import Enum
-from typing import Dict
+from typing import Dict, Optional
 import requests
 
+from tokmon.messagestore import MessageStore
+
 CHAT_EXCHANGE_API_ENDPOINT = "api/exchange"
 USAGE_SUMMARY_API_ENDPOINT = "api/summary"
 
 class BeamClient(object):
-    def __init__(self, remote_url: str, verbose: bool = False) -> None:
+    def __init__(self, remote_url: str, verbose: bool = False, compact: bool = False, message_store: Optional[MessageStore] = None) -> None:
         self.remote_url = remote_url
         self.verbose = verbose
+        self.compact = compact
+        # Pass the monitor's store so that messages it has interned aren't hashed again
+        self.message_store = message_store if message_store is not None else MessageStore()
+        # Refs of the messages the server has acknowledged
+        self.sent_refs = set()
 
     def get_summary_for_transport(self, monitored_program:str, summary: Dict) -> Dict:
         """
@@ -23,7 +30,7 @@ class BeamClient(object):
         Returns:
             Dict: The summary JSON object for transport to the remote server
         """
-        return {
+        summary_for_transport = {
             "tokmon_conversation_id": summary["tokmon_conversation_id"],
             "monitored_program": monitored_program,
             "total_cost": summary["total_cost"],
@@ -32,6 +39,45 @@ class BeamClient(object):
             "models": summary["models"]
         }
 
+        if "cache" in summary:
+            summary_for_transport["cache"] = summary["cache"]
+
+        return summary_for_transport
+
+    def compact_rt_blob(self, request: Dict, response: Dict) -> Dict:
+        """
+        Compact Round-Trip Blob
+
+        Replace the message lists of a request-response pair with message references,
+        and only include the messages that haven't been beamed yet.
+        `sent_refs` is left untouched: the new messages only count as sent once the server accepted them.
+
+        Args:
+            request (Dict): The request JSON object
+            response (Dict): The response JSON object
+
+        Returns:
+            Dict: The compact request, response and new messages
+        """
+        new_messages = {}
+
+        def to_refs(exchange_part: Dict) -> Dict:
+            message_refs = []
+            for message in exchange_part["messages"]:
+                ref = self.message_store.ref(message)
+                message_refs.append(ref)
+                if ref not in self.sent_refs and ref not in new_messages:
+                    new_messages[ref] = message
+            compact_part = {k: v for k, v in exchange_part.items() if k != "messages"}
+            compact_part["message_refs"] = message_refs
+            return compact_part
+
+        return {
+            "request": to_refs(request),
+            "response": to_refs(response),
+            "new_messages": new_messages
+        }
+
     def send_rt_blob(self, monitored_program:str, conversation_id: str, request: Dict, response: Dict, summary: Dict) -> None:
         """
         Send Round-Trip Blob
@@ -55,6 +101,9 @@ class BeamClient(object):
             "summary": self.get_summary_for_transport(monitored_program, summary)
         }
 
+        if self.compact:
+            json_payload.update(self.compact_rt_blob(request, response))
+
         remote_url = self.remote_url[:-1] if self.remote_url.endswith("/") else self.remote_url
         path = f"{remote_url}/{CHAT_EXCHANGE_API_ENDPOINT}"
 
@@ -69,6 +118,9 @@ class BeamClient(object):
             if self.verbose:
                 print(f"Error beaming to {path}: {str(e)}")
             raise e
+
+        if self.compact:
+            self.sent_refs.update(json_payload["new_messages"].keys())
         
     def send_summary_blob(self, monitored_program:str, summary: Dict) -> None:
         """
@@ -3,56 +3,22 @@ import argparse
 import json
 import sys
 import os
-import pkg_resources
 import time
-from typing import List, Tuple, Dict
+import uuid
+from typing import List, Dict
 
+from tokmon.common import PROG_NAME, OPENAI_API_PATH, MAGENTA, GRAY, GREEN, BLUE, ORANGE, color, print_usage_report, load_pricing, calculate_usage_cost
 from tokmon.tokmon import TokenMonitor
-from tokmon.costcalculator import CostCalculator
+from tokmon.costcalculator import CostCalculator, CostTracker
+from tokmon.live import LiveReporter
 from tokmon.beam import BeamClient
+from tokmon.messagestore import MessageStore
+from tokmon.responsecache import ResponseCache
+from tokmon.replay import replay_exchanges
+from tokmon.utils import allow_hosts_for_targets
+
+REPLAY_COMMAND = "replay"
 
-PROG_NAME = "tokmon"
-
-BOLD = "\033[1m"
-RESET = "\033[0m"
-MAGENTA = "\033[35m"
-
-WHITE = "\033[37m"
-GRAY = "\033[90m"
-GREEN = "\033[32m"
-BLUE = "\033[34m"
-ORANGE = "\033[33m"
-PINK = "\033[95m"
-
-def bold(s:str) -> str:
-    return f"{BOLD}{s}{RESET}"
-
-def color(s:str, color:str, bold:bool = True) -> str:
-    if bold:
-        return f"{BOLD}{color}{s}{RESET}"
-    else:
-        return f"{color}{s}{RESET}"
-
-def print_usage_report(monitored_invocation:str, cost_summary: Dict) -> None:
-    models = cost_summary["models"]
-    pricing = cost_summary["pricing_data"]
-    total_cost = cost_summary["total_cost"]
-    total_usage = cost_summary["total_usage"]
-
-    cost_str = f"${total_cost:.6f}"
-    report_header = f"{PROG_NAME} cost report:"
-
-    print(f"""
-{color(report_header, GREEN)}
-{color('='*80, GRAY, bold=False)}
-{bold("Monitored invocation")}: {monitored_invocation}
-{bold("Models")}: {models}
-{bold("Total Usage")}: {total_usage}
-{bold("Pricing")}: {pricing}
-{color("Total Cost", MAGENTA)}: {color(cost_str, MAGENTA)}
-{color('='*80, GRAY, bold=False)}
-""")
-          
 # ASCII ART for the tokmon logo
 # https://patorjk.com/software/taag/#p=display&f=Big&t=tokmon
 TOKMON_LOGO = color("""
@@ -64,14 +30,20 @@ TOKMON_LOGO = color("""
 """, GREEN, bold=False)
 
 
-OPENAI_API_PATH = "https://api.openai.com"
 DEFAULT_JSON_OUT_PATH = "/tmp"
+DEFAULT_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_CACHE_MAX_MB = 512
+DEFAULT_LIVE_INTERVAL_SECONDS = 5
 
 def cli():
     """
     The `tokmon` utility can be used to monitor the cost of OpenAI API calls made by a program.
     After te program has finished running, the `tokmon` will print the total cost of the program.
     """
+    if len(sys.argv) > 1 and sys.argv[1] == REPLAY_COMMAND:
+        replay_cli(sys.argv[2:])
+        return
+
     parser = argparse.ArgumentParser(description=f"""
 {TOKMON_LOGO}        
 
@@ -79,6 +51,8 @@ def cli():
 
 {color("• Example Usage:", BLUE)} {color("tokmon --json_out='.' <your program> [arg1] [arg2] ...", ORANGE, bold=False)}
 
+{color("• Offline re-accounting of captured traffic:", BLUE)} {color("tokmon replay --help", ORANGE, bold=False)}
+
 {color("• Important: you need to include the `--` arguments before the target program name and arguments.", MAGENTA)}
 
 {color("• Report Bugs & Get Help: https://github.com/yagil/tokmon/issues", GRAY)}
@@ -95,9 +69,18 @@ def cli():
     parser.add_argument("-v", "--verbose", action="store_true", help="Print verbose output")
     parser.add_argument("-j", "--json_out", type=str, help="Path to a JSON file to write the cost summary to. Saves to /tmp by default", default=DEFAULT_JSON_OUT_PATH)
     parser.add_argument("-n", "--no_json", action="store_true", help="Do not write a cost summary to a JSON file")
+    parser.add_argument("-t", "--target", type=str, action="append", help=f"Base URL of an API to monitor (repeatable, e.g. for Azure OpenAI or self-hosted gateways). Defaults to {OPENAI_API_PATH}. Traffic to other hosts is tunneled without interception", default=None)
+    parser.add_argument("-c", "--compact", action="store_true", help="Store each unique message once in the JSON summary and beam blobs, and refer to it by reference in later turns")
+    parser.add_argument("--cache_dir", type=str, help="Serve identical `temperature=0` requests from a local response cache stored in this directory", default=None)
+    parser.add_argument("--cache_ttl", type=float, help=f"Seconds before a cached response expires. Defaults to {DEFAULT_CACHE_TTL_SECONDS}", default=DEFAULT_CACHE_TTL_SECONDS)
+    parser.add_argument("--cache_max_mb", type=float, help=f"Maximum size of the response cache in MB. Defaults to {DEFAULT_CACHE_MAX_MB}", default=DEFAULT_CACHE_MAX_MB)
     parser.add_argument("-h", "--help", action="help", help="Show this help message and exit")
     
     parser.add_argument("--beam", type=str, help="""A url to a running "tokmon Beam" server. If provided, tokmon will send the usage summary to the server.""",)
+    parser.add_argument("-b", "--budget", type=float, help="Maximum cost in USD. Once it is reached, further API requests are answered with an error instead of being forwarded", default=None)
+    parser.add_argument("-l", "--live", action="store_true", help="Print a running usage and cost status line to stderr while the program runs")
+    parser.add_argument("-s", "--snapshot", type=str, help="Path to a JSON file that is kept up to date with the running usage and cost", default=None)
+    parser.add_argument("--live_interval", type=float, help=f"Minimum number of seconds between live status lines / snapshot updates. Defaults to {DEFAULT_LIVE_INTERVAL_SECONDS}", default=DEFAULT_LIVE_INTERVAL_SECONDS)
 
     args = parser.parse_args()
 
@@ -109,41 +92,66 @@ def cli():
         parser.print_help()
         sys.exit(1)
 
-    # Note: openai-pricing data may go out of date
-    if args.pricing:
-        pricing_json = args.pricing
-    else:
-        pricing_json = pkg_resources.resource_filename(PROG_NAME, "openai-pricing.json")
+    target_urls = args.target if args.target else [OPENAI_API_PATH]
+    try:
+        allow_hosts_for_targets(target_urls)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.live_interval <= 0:
+        parser.error("--live_interval must be greater than 0")
 
-    with open(pricing_json, "r") as f:
-        pricing = json.load(f)
+    pricing = load_pricing(args.pricing)
 
     monitored_prog = f"{args.program_name} { ' '.join(args.args) if args.args else ''}"
 
+    # Setup the (opt-in) response cache
+    response_cache = None
+    if args.cache_dir:
+        response_cache = ResponseCache(args.cache_dir,
+                                       ttl_seconds=args.cache_ttl,
+                                       max_bytes=int(args.cache_max_mb * 1024 * 1024))
+        if args.verbose:
+            print(f"[{PROG_NAME}] Caching deterministic responses in: {args.cache_dir}.")
+
+    # Instantiate the cost calculator
+    cost_calculator = CostCalculator(pricing, compact=args.compact)
+    cost_tracker = CostTracker(cost_calculator, budget=args.budget)
+
+    # Instantiate the token monitor
+    tokmon = TokenMonitor(target_urls,
+                          args.program_name,
+                          *args.args,
+                          verbose=args.verbose,
+                          response_cache=response_cache,
+                          cost_tracker=cost_tracker)
+
+    live_reporter = None
+    if args.live or args.snapshot:
+        live_reporter = LiveReporter(cost_tracker,
+                                     tokmon.conversation_id,
+                                     args.live_interval,
+                                     status_line=args.live,
+                                     snapshot_path=args.snapshot)
+        tokmon.live_reporter = live_reporter
+
     # Setup the beam client
     beam_client = None
     if args.beam:
         beam_url = args.beam
         if not beam_url.startswith("http"):
             beam_url = f"http://{beam_url}"
-        beam_client = BeamClient(beam_url, verbose=args.verbose)
+        beam_client = BeamClient(beam_url, verbose=args.verbose, compact=args.compact, message_store=tokmon.message_store)
         
         if args.verbose:
             print(f"[{PROG_NAME}] Beaming usage blobs to: {beam_url}.")
 
-    # Instantiate the cost calculator
-    cost_calculator = CostCalculator(pricing)
-
-    # Instantiate the token monitor
-    tokmon = TokenMonitor(OPENAI_API_PATH,
-                          args.program_name,
-                          *args.args,
-                          verbose=args.verbose)
-
     # Request-response handler
     def req_res_handler(conversation_id: str, request: Dict, response: Dict):
+        if live_reporter:
+            live_reporter.update()
         if beam_client:
-            cost_so_far = calculate_usage_cost(tokmon, cost_calculator)
+            cost_so_far = cost_tracker.summary(conversation_id)
             beam_client.send_rt_blob(monitored_prog, conversation_id, request, response, cost_so_far)
 
     tokmon.req_res_handler = req_res_handler
@@ -161,7 +169,15 @@ def cli():
         print(f"{color(interrupted_str, MAGENTA)}")
     finally:
         tokmon.stop_monitoring()
+
+        if live_reporter:
+            live_reporter.update(force=True)
         
+        # Requests can be blocked before any usage was recorded (e.g. `--budget 0`), so report them first
+        if tokmon.blocked_requests > 0:
+            blocked_str = f"[{PROG_NAME}] {tokmon.blocked_requests} API requests were blocked after the ${args.budget:.6f} budget was exceeded."
+            print(f"{color(blocked_str, MAGENTA)}")
+
         # Print usage report to the terminal
         cost_summary = calculate_usage_cost(tokmon, cost_calculator)
         if cost_summary is None:
@@ -177,21 +193,63 @@ def cli():
 
         # Write usage report to a JSON file (indepedent of beam'ing)
         if args.json_out and not args.no_json:
-            json_out_filename = f"{PROG_NAME}_usage_summary_{current_time}.json"
-            out_dir_path = args.json_out
-            if not os.path.exists(out_dir_path):
-                print(f"** Path does not exist: {out_dir_path}, falling back to {DEFAULT_JSON_OUT_PATH}")
-                out_dir_path = DEFAULT_JSON_OUT_PATH
-            json_out_path = os.path.join(out_dir_path, f"{json_out_filename}")
-            print(f"Writing cost summary to JSON file: {color(json_out_path, GREEN)} {color('(run with --no_json to disable this behavior)', GRAY)}")
-            with open(json_out_path, "w") as f:
-                 json.dump(cost_summary, f, indent=4)
-
-def calculate_usage_cost(monitor: TokenMonitor, calculator: CostCalculator):
-    conversation_id, usage_summary = monitor.usage_summary()
-    if (len(usage_summary) == 0):
-        return None
-    return calculator.calculate_cost(conversation_id, usage_summary)
+            write_json_summary(cost_summary, args.json_out, current_time)
+
+def replay_cli(argv: List[str]):
+    """
+    `tokmon replay` re-runs the cost accounting over previously captured traffic
+    (mitmproxy flow dumps, e.g. from `mitmdump -w`, or JSONL exchange logs).
+    """
+    parser = argparse.ArgumentParser(prog=f"{PROG_NAME} {REPLAY_COMMAND}",
+                                     description="Compute token usage and cost for captured OpenAI API traffic.")
+
+    current_time = int(time.time())
+
+    parser.add_argument("captures", nargs="+", help="Capture files: `.jsonl` exchange logs or mitmproxy flow dumps")
+    parser.add_argument("-p", "--pricing", type=str, help="Path to a custom OpenAI pricing JSON file", default=None)
+    parser.add_argument("-j", "--json_out", type=str, help="Path to a JSON file to write the cost summary to. Saves to /tmp by default", default=DEFAULT_JSON_OUT_PATH)
+    parser.add_argument("-n", "--no_json", action="store_true", help="Do not write a cost summary to a JSON file")
+    parser.add_argument("-t", "--target", type=str, action="append", help=f"Base URL of an API to account for (repeatable). Defaults to {OPENAI_API_PATH}", default=None)
+    parser.add_argument("-c", "--compact", action="store_true", help="Store each unique message once in the JSON summary, and refer to it by reference in later turns")
+    parser.add_argument("-w", "--workers", type=int, help="Number of worker processes. Defaults to the number of CPUs", default=None)
+
+    args = parser.parse_args(argv)
+
+    if args.no_json and args.json_out != DEFAULT_JSON_OUT_PATH:
+        parser.error("Cannot use --json_out and --no_json together")
+
+    target_urls = args.target if args.target else [OPENAI_API_PATH]
+    try:
+        allow_hosts_for_targets(target_urls)
+    except ValueError as e:
+        parser.error(str(e))
+
+    pricing = load_pricing(args.pricing)
+    replayed = ", ".join(args.captures)
+
+    message_store = MessageStore()
+    history = replay_exchanges(args.captures, target_urls, message_store, workers=args.workers)
+    if len(history) == 0:
+        status_str = f"[{PROG_NAME}] No OpenAI API calls found in {replayed}."
+        print(f"{color(status_str, MAGENTA)}")
+        return
+
+    cost_summary = CostCalculator(pricing, compact=args.compact).calculate_cost(str(uuid.uuid4()), history, message_store)
+    print_usage_report(f"{REPLAY_COMMAND} {replayed}", cost_summary)
+
+    if args.json_out and not args.no_json:
+        write_json_summary(cost_summary, args.json_out, current_time)
+
+def write_json_summary(cost_summary: Dict, json_out: str, current_time: int) -> None:
+    json_out_filename = f"{PROG_NAME}_usage_summary_{current_time}.json"
+    out_dir_path = json_out
+    if not os.path.exists(out_dir_path):
+        print(f"** Path does not exist: {out_dir_path}, falling back to {DEFAULT_JSON_OUT_PATH}")
+        out_dir_path = DEFAULT_JSON_OUT_PATH
+    json_out_path = os.path.join(out_dir_path, f"{json_out_filename}")
+    print(f"Writing cost summary to JSON file: {color(json_out_path, GREEN)} {color('(run with --no_json to disable this behavior)', GRAY)}")
+    with open(json_out_path, "w") as f:
+         json.dump(cost_summary, f, indent=4)
 
 if __name__ == '__main__':
     cli()
\ No newline at end of file
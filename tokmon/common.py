@@ -0,0 +1,69 @@
+import json
+import os
+from typing import Dict, Optional
+
+from tokmon.costcalculator import CostCalculator
+from tokmon.recorder import UsageRecorder
+
+PROG_NAME = "tokmon"
+
+OPENAI_API_PATH = "https://api.openai.com"
+DEFAULT_PRICING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "openai-pricing.json")
+
+BOLD = "\033[1m"
+RESET = "\033[0m"
+MAGENTA = "\033[35m"
+
+WHITE = "\033[37m"
+GRAY = "\033[90m"
+GREEN = "\033[32m"
+BLUE = "\033[34m"
+ORANGE = "\033[33m"
+PINK = "\033[95m"
+
+def bold(s:str) -> str:
+    return f"{BOLD}{s}{RESET}"
+
+def color(s:str, color:str, bold:bool = True) -> str:
+    if bold:
+        return f"{BOLD}{color}{s}{RESET}"
+    else:
+        return f"{color}{s}{RESET}"
+
+def print_usage_report(monitored_invocation:str, cost_summary: Dict) -> None:
+    models = cost_summary["models"]
+    pricing = cost_summary["pricing_data"]
+    total_cost = cost_summary["total_cost"]
+    total_usage = cost_summary["total_usage"]
+
+    cost_str = f"${total_cost:.6f}"
+
+    cache_str = ""
+    if "cache" in cost_summary:
+        cache = cost_summary["cache"]
+        cache_str = f"\n{bold('Cache')}: {cache['hits']} hits, {cache['avoided_tokens']} tokens, ${cache['avoided_cost']:.6f} avoided (not included above)"
+    report_header = f"{PROG_NAME} cost report:"
+
+    print(f"""
+{color(report_header, GREEN)}
+{color('='*80, GRAY, bold=False)}
+{bold("Monitored invocation")}: {monitored_invocation}
+{bold("Models")}: {models}
+{bold("Total Usage")}: {total_usage}
+{bold("Pricing")}: {pricing}
+{color("Total Cost", MAGENTA)}: {color(cost_str, MAGENTA)}{cache_str}
+{color('='*80, GRAY, bold=False)}
+""")
+
+def load_pricing(pricing_path: Optional[str]) -> Dict:
+    # Note: openai-pricing data may go out of date
+    pricing_json = pricing_path if pricing_path else DEFAULT_PRICING_PATH
+
+    with open(pricing_json, "r") as f:
+        return json.load(f)
+
+def calculate_usage_cost(monitor: UsageRecorder, calculator: CostCalculator):
+    conversation_id, usage_summary = monitor.usage_summary()
+    if (len(usage_summary) == 0):
+        return None
+    return calculator.calculate_cost(conversation_id, usage_summary, monitor.message_store)
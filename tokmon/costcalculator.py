@@ -1,19 +1,21 @@
-from typing import List, Tuple, Dict
+import itertools
+import threading
+from typing import Iterable, List, Tuple, Dict, Optional, Set
+
+from tokmon.messagestore import MessageStore
 
 class CostCalculator:
-    def __init__(self, pricing_data: Dict[str, Dict[str, float]]) -> None:
+    def __init__(self, pricing_data: Dict[str, Dict[str, float]], compact: bool = False) -> None:
         self.pricing_data = pricing_data
+        self.compact = compact
 
     def calculate_cost_for_tokens(self, tokens, price, per_tokens):
         return (float(tokens) / per_tokens) * price
 
-    def calculate_round_trip_cost(self, request: Dict, response: Dict):
+    def calculate_usage_cost(self, model: str, usage_data: Dict) -> Tuple[Dict, float]:
         """
-        Calculate cost & usage for a single round trip (request -> response)
+        Calculate the cost of the token usage of a single response
         """
-        model = response["model"]
-        usage_data = response["usage"]
-        
         prompt_tokens = usage_data["prompt_tokens"]
         completion_tokens = usage_data["completion_tokens"]
         total_tokens = usage_data["total_tokens"]
@@ -36,21 +38,57 @@ class CostCalculator:
             price = model_pricing_data["cost"]
             total_cost = self.calculate_cost_for_tokens(total_tokens, price, per_tokens)
 
-        messages = request["messages"] + response["messages"]
+        return model_pricing_data, total_cost
+
+    def calculate_round_trip_cost(self, request: Dict, response: Dict, message_store: Optional[MessageStore] = None, seen_refs: Optional[Set[str]] = None):
+        """
+        Calculate cost & usage for a single round trip (request -> response)
+        In compact mode, `message_store` and `seen_refs` (the refs included by earlier round trips) are required.
+        """
+        model = response["model"]
+        usage_data = response["usage"]
+        model_pricing_data, total_cost = self.calculate_usage_cost(model, usage_data)
 
         cost_summary = {
             "model": model,
-            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": total_tokens },
+            "usage": {"prompt_tokens": usage_data["prompt_tokens"], "completion_tokens": usage_data["completion_tokens"], "total_tokens": usage_data["total_tokens"] },
             "cost": total_cost,
-            "messages": messages
         }
+
+        if self.compact:
+            messages = itertools.chain(request["messages"], response["messages"])
+            cost_summary["message_refs"], cost_summary["new_messages"] = self.compact_messages(messages, message_store, seen_refs)
+        else:
+            cost_summary["messages"] = request["messages"] + response["messages"]
+
+        if response.get("cached", False):
+            cost_summary["cached"] = True
         
         return model_pricing_data, cost_summary
 
-    def calculate_cost(self, conversation_id: str, usage_data: List[Tuple[Dict, Dict]]):
+    def compact_messages(self, messages: Iterable[Dict], message_store: MessageStore, seen_refs: Set[str]) -> Tuple[List[str], Dict[str, Dict]]:
+        """
+        References to the messages of a round trip, plus the messages not included in an earlier round trip
+        """
+        message_refs = []
+        new_messages = {}
+        for message in messages:
+            ref = message_store.ref(message)
+            message_refs.append(ref)
+            if ref not in seen_refs:
+                seen_refs.add(ref)
+                new_messages[ref] = message
+
+        return message_refs, new_messages
+
+    def calculate_cost(self, conversation_id: str, usage_data: List[Tuple[Dict, Dict]], message_store: Optional[MessageStore] = None):
         """
         Calculate cost & usage for all of (request, response) pairs, return a summary
         """
+        if self.compact and message_store is None:
+            message_store = MessageStore()
+        seen_refs = set()
+
         total_cost = 0.0
         total_prompt_tokens = 0
         total_completion_tokens = 0
@@ -58,20 +96,31 @@ class CostCalculator:
         pricing_data = {}
         models = set()
         raw_data = []
+        cache_hits = 0
+        cache_avoided_cost = 0.0
+        cache_avoided_tokens = 0
 
         for request, response in usage_data:
-            model_pricing, round_trip_cost = self.calculate_round_trip_cost(request, response)
+            model_pricing, round_trip_cost = self.calculate_round_trip_cost(request, response, message_store, seen_refs)
+            model = round_trip_cost["model"]
+            models.add(model)
+            pricing_data[model] = model_pricing
+            raw_data.append(round_trip_cost)
+
             usage = round_trip_cost["usage"]
+            if round_trip_cost.get("cached", False):
+                # Served from the local response cache: nothing was billed upstream
+                cache_hits += 1
+                cache_avoided_cost += round_trip_cost["cost"]
+                cache_avoided_tokens += usage["total_tokens"]
+                continue
+
             total_prompt_tokens += usage["prompt_tokens"]
             total_completion_tokens += usage["completion_tokens"]
             total_tokens += usage["total_tokens"]
             total_cost += round_trip_cost["cost"]
-            model = round_trip_cost["model"]
-            models.add(model)
-            pricing_data[model] = model_pricing
-            raw_data.append(round_trip_cost)
 
-        return {
+        summary = {
             "tokmon_conversation_id": conversation_id,
             "total_cost": total_cost,
             "total_usage": {
@@ -82,4 +131,109 @@ class CostCalculator:
             "pricing_data": str(pricing_data),
             "models": list(models),
             "raw_data": raw_data
-        }
\ No newline at end of file
+        }
+
+        if cache_hits > 0:
+            summary["cache"] = {
+                "hits": cache_hits,
+                "avoided_cost": cache_avoided_cost,
+                "avoided_tokens": cache_avoided_tokens,
+            }
+
+        return summary
+
+class CostTracker:
+    """
+    Running token usage and cost per model, updated in O(1) as each round trip completes.
+    Unlike `CostCalculator.calculate_cost`, it never walks the history, so it is cheap enough to query after every request.
+    """
+    def __init__(self, calculator: CostCalculator, budget: Optional[float] = None) -> None:
+        self.calculator = calculator
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.total_cost = 0.0
+        self.total_prompt_tokens = 0
+        self.total_completion_tokens = 0
+        self.total_tokens = 0
+        self.requests = 0
+        self.models: Dict[str, Dict] = {}
+        self.pricing_data: Dict[str, Dict] = {}
+        self.cache_hits = 0
+        self.cache_avoided_cost = 0.0
+        self.cache_avoided_tokens = 0
+        # Models missing from the pricing data: their tokens are tracked at zero cost
+        self.unpriced_models: Set[str] = set()
+
+    def add(self, response: Dict) -> float:
+        """
+        Account for a completed round trip, return its cost
+        """
+        model = response["model"]
+        usage = response["usage"]
+        model_pricing = None
+        if model in self.calculator.pricing_data:
+            model_pricing, cost = self.calculator.calculate_usage_cost(model, usage)
+        else:
+            # Runs inside the response hooks, so an unknown model must not break the monitored program's traffic
+            cost = 0.0
+
+        with self.lock:
+            if model_pricing is not None:
+                self.pricing_data[model] = model_pricing
+            elif model not in self.unpriced_models:
+                self.unpriced_models.add(model)
+                print(f"[tokmon] Warning: no pricing data for model '{model}'. Its tokens are tracked at zero cost.")
+
+            if response.get("cached", False):
+                self.cache_hits += 1
+                self.cache_avoided_cost += cost
+                self.cache_avoided_tokens += usage["total_tokens"]
+                return cost
+
+            self.requests += 1
+            self.total_cost += cost
+            self.total_prompt_tokens += usage["prompt_tokens"]
+            self.total_completion_tokens += usage["completion_tokens"]
+            self.total_tokens += usage["total_tokens"]
+
+            model_totals = self.models.setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost": 0.0})
+            model_totals["requests"] += 1
+            model_totals["prompt_tokens"] += usage["prompt_tokens"]
+            model_totals["completion_tokens"] += usage["completion_tokens"]
+            model_totals["total_tokens"] += usage["total_tokens"]
+            model_totals["cost"] += cost
+
+        return cost
+
+    def budget_exceeded(self) -> bool:
+        """
+        Whether the billed cost has reached the budget (cache hits don't count)
+        """
+        return self.budget is not None and self.total_cost >= self.budget
+
+    def summary(self, conversation_id: str) -> Dict:
+        """
+        Running summary, in the same format as `CostCalculator.calculate_cost` (without the `raw_data`)
+        """
+        with self.lock:
+            summary = {
+                "tokmon_conversation_id": conversation_id,
+                "total_cost": self.total_cost,
+                "total_usage": {
+                    "total_prompt_tokens": self.total_prompt_tokens,
+                    "total_completion_tokens": self.total_completion_tokens,
+                    "total_tokens": self.total_tokens,
+                },
+                "pricing_data": str(self.pricing_data),
+                "models": list(self.pricing_data.keys()) + sorted(self.unpriced_models - self.pricing_data.keys()),
+                "per_model": {model: dict(totals) for model, totals in self.models.items()},
+            }
+
+            if self.cache_hits > 0:
+                summary["cache"] = {
+                    "hits": self.cache_hits,
+                    "avoided_cost": self.cache_avoided_cost,
+                    "avoided_tokens": self.cache_avoided_tokens,
+                }
+
+        return summary
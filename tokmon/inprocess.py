@@ -0,0 +1,212 @@
+import contextlib
+import functools
+import json
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Union
+
+from tokmon.common import OPENAI_API_PATH, PROG_NAME, calculate_usage_cost, load_pricing, print_usage_report
+from tokmon.costcalculator import CostCalculator, CostTracker
+from tokmon.recorder import UsageRecorder
+
+# Monitors that are currently active. The HTTP client hooks are installed while this list is non-empty.
+active_monitors: List["InProcessMonitor"] = []
+active_monitors_lock = threading.Lock()
+
+# Original client methods, restored when the last monitor exits
+original_methods: Dict[str, Callable] = {}
+
+class InProcessMonitor(contextlib.ContextDecorator):
+    """
+    Monitor OpenAI API usage from inside a Python program, without the mitmproxy hop.
+
+    Hooks into `requests` and `httpx` (whichever are installed) while active, and feeds every
+    exchange with a target URL through the same accounting as the proxy (`UsageRecorder`).
+    Entering the same instance again (recursive decorated calls, several threads) is counted once;
+    the report is produced when the outermost block exits.
+
+    Usage:
+        with InProcessMonitor() as monitor:
+            openai.ChatCompletion.create(...)
+
+        @InProcessMonitor(pricing="/path/to/custom-openai-pricing.json")
+        def main(): ...
+    """
+    def __init__(self,
+                 target_urls: Union[str, List[str]] = OPENAI_API_PATH,
+                 pricing: Optional[str] = None,
+                 beam_url: Optional[str] = None,
+                 print_report: bool = True,
+                 compact: bool = False,
+                 verbose: bool = False
+                ):
+        self.cost_calculator = CostCalculator(load_pricing(pricing), compact=compact)
+        self.cost_tracker = CostTracker(self.cost_calculator)
+        self.monitor = UsageRecorder(target_urls,
+                                     verbose=verbose,
+                                     req_res_handler=self.handle_exchange,
+                                     cost_tracker=self.cost_tracker)
+        self.active_count = 0
+        self.print_report = print_report
+        self.verbose = verbose
+        self.monitored_invocation = " ".join(sys.argv)
+
+        self.beam_client = None
+        if beam_url:
+            from tokmon.beam import BeamClient
+
+            if not beam_url.startswith("http"):
+                beam_url = f"http://{beam_url}"
+            self.beam_client = BeamClient(beam_url, verbose=verbose, compact=compact, message_store=self.monitor.message_store)
+
+    def __enter__(self) -> "InProcessMonitor":
+        with active_monitors_lock:
+            if not active_monitors:
+                install_hooks()
+            if self.active_count == 0:
+                active_monitors.append(self)
+            self.active_count += 1
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        with active_monitors_lock:
+            self.active_count -= 1
+            if self.active_count > 0:
+                return False
+            active_monitors.remove(self)
+            if not active_monitors:
+                uninstall_hooks()
+
+        cost_summary = self.cost_summary()
+        if cost_summary is not None:
+            if self.print_report:
+                print_usage_report(self.monitored_invocation, cost_summary)
+            if self.beam_client:
+                self.beam_client.send_summary_blob(self.monitored_invocation, cost_summary)
+        elif self.verbose:
+            print(f"[{PROG_NAME}] No OpenAI API calls detected.")
+
+        return False
+
+    def cost_summary(self) -> Optional[Dict]:
+        return calculate_usage_cost(self.monitor, self.cost_calculator)
+
+    def handle_exchange(self, conversation_id: str, request: Dict, response: Dict):
+        if self.beam_client:
+            cost_so_far = self.cost_tracker.summary(conversation_id)
+            self.beam_client.send_rt_blob(self.monitored_invocation, conversation_id, request, response, cost_so_far)
+
+    def observe(self, url: str, request_body: Optional[Union[bytes, str]], response_body: Union[bytes, str]):
+        if self.monitor.target_matcher.match(url) is None or not request_body:
+            return
+
+        try:
+            request_data = json.loads(request_body)
+            using_stream = request_data["stream"] if "stream" in request_data else False
+            if isinstance(response_body, bytes):
+                response_body = response_body.decode("utf-8")
+            self.monitor.record_exchange(request_data, response_body, using_stream)
+        except Exception as e:
+            # Never let accounting errors break the monitored program's API calls
+            print(f"[{PROG_NAME}] Error handling exchange for {url}: {str(e)}")
+
+def observe_exchange(url: str, request_body: Optional[Union[bytes, str]], response_body: Union[bytes, str]):
+    for monitor in list(active_monitors):
+        monitor.observe(url, request_body, response_body)
+
+def tee_chunks(chunks, on_complete: Callable[[bytes], None]):
+    """
+    Pass streamed chunks through to the caller untouched, and hand the full body to `on_complete` once consumed.
+    """
+    received = []
+    for chunk in chunks:
+        received.append(chunk)
+        yield chunk
+    on_complete(join_chunks(received))
+
+async def atee_chunks(chunks, on_complete: Callable[[bytes], None]):
+    received = []
+    async for chunk in chunks:
+        received.append(chunk)
+        yield chunk
+    on_complete(join_chunks(received))
+
+def join_chunks(chunks: List[Union[bytes, str]]) -> bytes:
+    return b"".join(chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in chunks)
+
+def install_hooks():
+    try:
+        import requests
+    except ImportError:
+        pass
+    else:
+        original_methods["requests.Session.send"] = requests.Session.send
+        requests.Session.send = requests_send_hook(requests.Session.send)
+
+    try:
+        import httpx
+    except ImportError:
+        pass
+    else:
+        original_methods["httpx.Client.send"] = httpx.Client.send
+        original_methods["httpx.AsyncClient.send"] = httpx.AsyncClient.send
+        httpx.Client.send = httpx_send_hook(httpx.Client.send)
+        httpx.AsyncClient.send = httpx_async_send_hook(httpx.AsyncClient.send)
+
+def uninstall_hooks():
+    if "requests.Session.send" in original_methods:
+        import requests
+        requests.Session.send = original_methods.pop("requests.Session.send")
+
+    if "httpx.Client.send" in original_methods:
+        import httpx
+        httpx.Client.send = original_methods.pop("httpx.Client.send")
+        httpx.AsyncClient.send = original_methods.pop("httpx.AsyncClient.send")
+
+def requests_send_hook(send):
+    @functools.wraps(send)
+    def hooked_send(session, request, **kwargs):
+        response = send(session, request, **kwargs)
+        on_complete = lambda body: observe_exchange(request.url, request.body, body)
+
+        if response._content_consumed:
+            on_complete(response.content)
+        else:
+            # Streamed response: `iter_lines`, `iter_content` and `.content` all read through `iter_content`
+            iter_content = response.iter_content
+            response.iter_content = lambda *args, **kw: tee_chunks(iter_content(*args, **kw), on_complete)
+        return response
+    return hooked_send
+
+def httpx_send_hook(send):
+    @functools.wraps(send)
+    def hooked_send(client, request, **kwargs):
+        response = send(client, request, **kwargs)
+        # Streamed uploads have no buffered body; those are never API calls we account for
+        request_body = request.content if hasattr(request, "_content") else None
+        on_complete = lambda body: observe_exchange(str(request.url), request_body, body)
+
+        if hasattr(response, "_content"):
+            on_complete(response.content)
+        else:
+            # Streamed response: `iter_lines`, `iter_text` and `read` all read through `iter_bytes`
+            iter_bytes = response.iter_bytes
+            response.iter_bytes = lambda *args, **kw: tee_chunks(iter_bytes(*args, **kw), on_complete)
+        return response
+    return hooked_send
+
+def httpx_async_send_hook(send):
+    @functools.wraps(send)
+    async def hooked_send(client, request, **kwargs):
+        response = await send(client, request, **kwargs)
+        # Streamed uploads have no buffered body; those are never API calls we account for
+        request_body = request.content if hasattr(request, "_content") else None
+        on_complete = lambda body: observe_exchange(str(request.url), request_body, body)
+
+        if hasattr(response, "_content"):
+            on_complete(response.content)
+        else:
+            aiter_bytes = response.aiter_bytes
+            response.aiter_bytes = lambda *args, **kw: atee_chunks(aiter_bytes(*args, **kw), on_complete)
+        return response
+    return hooked_send
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Optional
+
+from tokmon.costcalculator import CostTracker
+
+class LiveReporter(object):
+    """
+    Throttled live view of the running totals: a status line on stderr and/or a JSON snapshot file.
+    At most one update is written per `interval` seconds, so the cost per request stays negligible. An update that
+    arrives sooner is held back, and written by `run` once the interval has passed.
+    """
+    def __init__(self,
+                 cost_tracker: CostTracker,
+                 conversation_id: str,
+                 interval: float,
+                 status_line: bool = False,
+                 snapshot_path: Optional[str] = None
+                ) -> None:
+        self.cost_tracker = cost_tracker
+        self.conversation_id = conversation_id
+        self.interval = interval
+        self.status_line = status_line
+        self.snapshot_path = snapshot_path
+        self.last_update = 0.0
+        self.pending = False
+
+    def update(self, force: bool = False) -> None:
+        self.pending = True
+        now = time.monotonic()
+        if not force and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+        self.pending = False
+
+        summary = self.cost_tracker.summary(self.conversation_id)
+
+        if self.status_line:
+            total_usage = summary["total_usage"]
+            print(f"[tokmon] {self.cost_tracker.requests} requests | {total_usage['total_tokens']} tokens | ${summary['total_cost']:.6f}", file=sys.stderr)
+
+        if self.snapshot_path:
+            self.write_snapshot(summary)
+
+    def flush(self) -> None:
+        """
+        Write the held back update, if any, once the interval since the last one has passed
+        """
+        if self.pending and time.monotonic() - self.last_update >= self.interval:
+            self.update(force=True)
+
+    async def run(self) -> None:
+        """
+        Flush held back updates on time, until cancelled
+        """
+        while True:
+            remaining = self.last_update + self.interval - time.monotonic()
+            await asyncio.sleep(remaining if self.pending and remaining > 0 else self.interval)
+            self.flush()
+
+    def write_snapshot(self, summary: dict) -> None:
+        summary["timestamp"] = time.time()
+
+        # Write to a temporary file first so readers never see a partial snapshot
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(summary, f, indent=4)
+        os.replace(tmp_path, self.snapshot_path)
@@ -0,0 +1,61 @@
+import hashlib
+import json
+from typing import Dict
+
+MESSAGE_REF_LENGTH = 16
+
+class MessageStore(object):
+    """
+    Content-addressed store for chat messages.
+
+    Every turn of a conversation re-sends the whole message history. Interning makes all turns share
+    a single dict per unique message, and gives each message a stable reference for compact summaries.
+    """
+    def __init__(self) -> None:
+        self.messages: Dict[str, Dict] = {}
+        # Interned messages are kept alive by `self.messages`, so their `id()` is a safe shortcut for hashing
+        self.refs_by_object: Dict[int, str] = {}
+
+    @staticmethod
+    def hash_message(message: Dict) -> str:
+        canonical = json.dumps(message, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:MESSAGE_REF_LENGTH]
+
+    def ref(self, message: Dict) -> str:
+        """
+        Ref
+
+        Get the reference of a message, interning it if it hasn't been seen before.
+
+        Args:
+            message (Dict): The message JSON object
+
+        Returns:
+            str: The message reference
+        """
+        ref = self.refs_by_object.get(id(message))
+        if ref is not None:
+            return ref
+
+        ref = self.hash_message(message)
+        if ref not in self.messages:
+            self.messages[ref] = message
+            self.refs_by_object[id(message)] = ref
+        return ref
+
+    def intern(self, message: Dict) -> Dict:
+        """
+        Intern
+
+        Get the stored message with the same content (storing this one if it is new).
+
+        Args:
+            message (Dict): The message JSON object
+
+        Returns:
+            Dict: The shared message JSON object
+        """
+        return self.messages[self.ref(message)]
+
+    def get(self, ref: str) -> Dict:
+        return self.messages[ref]
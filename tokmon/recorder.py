@@ -0,0 +1,145 @@
+import json
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from tokmon.costcalculator import CostTracker
+from tokmon.messagestore import MessageStore
+from tokmon.utils import count_tokens_in_json, compile_target_matcher
+
+RequestResponseHandler = Callable[[str, Dict, Dict], None]
+
+class UsageRecorder:
+    """
+    Token accounting shared by the proxy (`TokenMonitor`), the in-process mode and replays.
+    Has no dependency on mitmproxy.
+    """
+    def __init__(self,
+                 target_urls: Union[str, List[str]],
+                 verbose: bool = False,
+                 req_res_handler: RequestResponseHandler = None,
+                 cost_tracker: Optional[CostTracker] = None
+                ):
+        if isinstance(target_urls, str):
+            target_urls = [target_urls]
+        self.target_urls = list(target_urls)
+        self.target_matcher = compile_target_matcher(self.target_urls)
+        self.verbose = verbose
+        self.history: List[Tuple[Dict, Dict]] = []
+        self.message_store = MessageStore()
+        self.req_res_handler = req_res_handler
+        self.cost_tracker = cost_tracker
+        self.conversation_id = str(uuid.uuid4())
+
+    def append_history(self, request: Dict, response: Dict):
+        self.history.append((request, response))
+
+    def record_exchange(self, request: Dict, response_text: str, using_stream: bool, cached: bool = False) -> Tuple[Dict, Dict]:
+        """
+        Account for a completed exchange, whether it was seen by the proxy, the in-process hooks or a replay.
+        """
+        request, response = self.build_exchange(request, response_text, using_stream)
+        if cached:
+            response["cached"] = True
+
+        # Add the request and response to the rolling history
+        self.append_history(request, response)
+
+        if self.cost_tracker is not None:
+            self.cost_tracker.add(response)
+
+        # Invoke the delegate callback for additional handling on the response object
+        if self.req_res_handler is not None:
+            self.req_res_handler(self.conversation_id, request, response)
+
+        if self.verbose:
+            print(response)
+
+        return request, response
+
+    def build_exchange(self, request: Dict, response_text: str, using_stream: bool, intern: bool = True) -> Tuple[Dict, Dict]:
+        """
+        Turn a raw request body and response text into the (request, response) pair kept in `history`.
+        With `intern=False` the messages are not added to `message_store` (e.g. when they are interned elsewhere).
+        """
+        if using_stream:
+            model, content, usage = self.handle_stream_response(response_text, request)
+        else:
+            response_data = json.loads(response_text)
+            model = response_data["model"]
+            content = response_data["choices"][0]["message"]["content"]
+            usage = response_data["usage"]
+
+        # The messages are sent to OpenAI in the order that it makes sense for the LLM to read them
+        # But we want to display them in the order that they were sent by the user (i.e., the reversed order)
+        # Messages are interned so that the turns of a conversation share a single copy of each message
+        intern_message = self.message_store.intern if intern else (lambda message: message)
+        request["messages"] = [intern_message(x) for x in reversed(request["messages"])]
+
+        response = {
+            "model": model,
+            "messages": [intern_message({"role": "assistant", "content": content})],
+            "usage": usage
+        }
+        return request, response
+
+    def encode(self, model, text):
+        """
+        Learn more: https://github.com/openai/tiktoken
+        """
+        # Only needed for streamed responses, so the in-process mode doesn't pay for the import up front
+        import tiktoken
+
+        tokenizer = tiktoken.encoding_for_model(model)
+        return tokenizer.encode(text)
+
+    def handle_stream_response(self, raw_messages: str, request: Dict):
+        """
+        When streaming, OpenAI's API doesn't return usage data.
+        To work around this, we use tiktoken directly.
+
+        See: https://community.openai.com/t/usage-info-in-api-responses/18862/11
+        """
+
+        model = None
+
+        completion_tokens = 0
+        completion_content = ""
+
+        # The SSE chunks are buffered as one big string
+        for msg in raw_messages.split("\n"):
+            if msg.startswith("data:"):
+                try:
+                    msg = msg[5:]
+                    if "".join(msg.split()) == "[DONE]":
+                        break
+                    msg = json.loads(msg)
+                    model = msg["model"]
+                    
+                    choice = msg["choices"][0]
+                    if "delta" in choice:
+                        if "content" in choice["delta"]:
+                            tokens = choice["delta"]["content"]
+                            completion_content += tokens
+                            encoded_tokens = self.encode(model, tokens)
+                            completion_tokens += len(encoded_tokens)
+
+                except json.JSONDecodeError as e:
+                    print(f"\n\n ! ! Failed to parse response data as JSON {e} --- <{msg}> ! !\n\n")
+                except Exception as e:
+                    print(f"\n\n ! ! Failed to parse response data: {e} ! !\n\n")
+                    raise e
+        
+        encode_lambda = lambda text: self.encode(model, text)
+        prompt_tokens = count_tokens_in_json(encode_lambda, request)
+        total_tokens = prompt_tokens + completion_tokens
+        
+        # mimic the usage data returned by the API in the non streaming case
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens
+        }
+        return model, completion_content, usage
+
+    def usage_summary(self):
+        return self.conversation_id, self.history
@@ -0,0 +1,140 @@
+import itertools
+import json
+import multiprocessing
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from tokmon.messagestore import MessageStore
+from tokmon.recorder import UsageRecorder
+from tokmon.utils import compile_target_matcher
+
+# (url, request body, response text)
+RawExchange = Tuple[Optional[str], str, str]
+
+JSONL_SUFFIX = ".jsonl"
+# Exchanges per pool task, and pool tasks per worker in each batch handed to the pool
+REPLAY_CHUNK_SIZE = 16
+REPLAY_TASKS_PER_WORKER = 4
+
+# Per-process recorder used by the pool workers (set in `init_worker`)
+worker_recorder: Optional[UsageRecorder] = None
+
+def iter_jsonl_exchanges(path: str, target_matcher: re.Pattern) -> Iterator[RawExchange]:
+    """
+    Iterate over the target exchanges of a JSONL exchange log, one line at a time.
+
+    Each line is an object with a `request` (the request JSON body), a `response` (the raw response text,
+    or the response JSON object) and an optional `url`. Lines without a `url` are assumed to be target exchanges.
+    """
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                url = entry.get("url")
+                if url is not None and target_matcher.match(url) is None:
+                    continue
+                request = entry["request"]
+                response = entry["response"]
+            except (json.JSONDecodeError, KeyError) as e:
+                print(f"[tokmon] Skipping malformed exchange at {path}:{line_number}: {e}")
+                continue
+
+            request_text = request if isinstance(request, str) else json.dumps(request)
+            response_text = response if isinstance(response, str) else json.dumps(response)
+            yield url, request_text, response_text
+
+def iter_flow_exchanges(path: str, target_matcher: re.Pattern) -> Iterator[RawExchange]:
+    """
+    Iterate over the target exchanges of a mitmproxy flow dump (e.g. written by `mitmdump -w`), one flow at a time.
+    Other flows are skipped before their bodies are decoded.
+    """
+    from mitmproxy import http, io
+
+    with open(path, "rb") as f:
+        for flow in io.FlowReader(f).stream():
+            if not isinstance(flow, http.HTTPFlow) or flow.response is None:
+                continue
+            if target_matcher.match(flow.request.pretty_url) is None:
+                continue
+            if flow.request.content is None or flow.response.text is None:
+                continue
+            yield flow.request.pretty_url, flow.request.get_text(), flow.response.text
+
+def iter_exchanges(paths: List[str], target_urls: List[str]) -> Iterator[RawExchange]:
+    """
+    Iterate over the target exchanges of all captures. Filtering happens here, in the reader,
+    so that only the exchanges to account for are decoded and sent to the pool workers.
+    """
+    target_matcher = compile_target_matcher(target_urls)
+    for path in paths:
+        if path.endswith(JSONL_SUFFIX):
+            yield from iter_jsonl_exchanges(path, target_matcher)
+        else:
+            yield from iter_flow_exchanges(path, target_matcher)
+
+def init_worker(target_urls: List[str]) -> None:
+    global worker_recorder
+    worker_recorder = UsageRecorder(target_urls)
+
+def account_exchange(exchange: RawExchange) -> Optional[Tuple[Dict, Dict]]:
+    """
+    Build the (request, response) history entry for a single captured exchange, or None if it is skipped.
+    """
+    url, request_text, response_text = exchange
+    try:
+        request_data = json.loads(request_text)
+        using_stream = request_data["stream"] if "stream" in request_data else False
+        # The main process interns the returned messages; interning here too would grow the worker's store forever
+        return worker_recorder.build_exchange(request_data, response_text, using_stream, intern=False)
+    except Exception as e:
+        print(f"[tokmon] Skipping exchange for {url}: {e}")
+        return None
+
+def replay_exchanges(paths: List[str], target_urls: List[str], message_store: MessageStore, workers: Optional[int] = None) -> List[Tuple[Dict, Dict]]:
+    """
+    Replay Exchanges
+
+    Re-run the token accounting over captured traffic, spreading the work across `workers` processes.
+    Captures are read incrementally and handed to the pool in bounded batches, so large files are never
+    loaded into memory at once. The next batch is read while the workers process the current one.
+
+    Args:
+        paths (List[str]): Capture files (`.jsonl` exchange logs or mitmproxy flow dumps)
+        target_urls (List[str]): Base URLs of the monitored APIs
+        message_store (MessageStore): Store the messages of the replayed exchanges are interned in
+        workers (Optional[int]): Number of worker processes. Defaults to the number of CPUs
+
+    Returns:
+        List[Tuple[Dict, Dict]]: The (request, response) history, in capture order
+    """
+    history = []
+    exchanges = iter_exchanges(paths, target_urls)
+    workers = workers or os.cpu_count() or 1
+    batch_size = workers * REPLAY_CHUNK_SIZE * REPLAY_TASKS_PER_WORKER
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(target_urls,)) as pool:
+        def submit_next_batch():
+            batch = list(itertools.islice(exchanges, batch_size))
+            if not batch:
+                return None
+            return pool.imap(account_exchange, batch, chunksize=REPLAY_CHUNK_SIZE)
+
+        # At most two batches are in flight: the one being consumed, and the one queued behind it
+        pending = submit_next_batch()
+        while pending is not None:
+            results = pending
+            pending = submit_next_batch()
+            for entry in results:
+                if entry is None:
+                    continue
+                # Messages come back from the workers as separate copies; share them across turns again
+                request, response = entry
+                request["messages"] = [message_store.intern(x) for x in request["messages"]]
+                response["messages"] = [message_store.intern(x) for x in response["messages"]]
+                history.append(entry)
+
+    return history
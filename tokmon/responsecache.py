@@ -0,0 +1,176 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Headers that describe the original transfer rather than the payload; they are recomputed on replay
+UNCACHED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "date", "set-cookie"}
+
+CACHE_FILE_SUFFIX = ".json"
+
+# Evict down to this fraction of `max_bytes`, so that a full cache isn't rescanned on every store
+EVICTION_TARGET_RATIO = 0.9
+
+class ResponseCache(object):
+    def __init__(self, cache_dir: str, ttl_seconds: Optional[float] = None, max_bytes: Optional[int] = None) -> None:
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Running estimate of the cache size, so that `put` only scans the directory when eviction is needed
+        self.total_bytes = sum(size for _, size, _ in self.scan())
+
+    @staticmethod
+    def is_cacheable(request_data: Dict) -> bool:
+        """
+        Is Cacheable
+
+        Only deterministic requests (explicit `temperature=0`, single completion) are served from the cache.
+
+        Args:
+            request_data (Dict): The request JSON object
+
+        Returns:
+            bool: True if the response to this request can be cached
+        """
+        return request_data.get("temperature") == 0 and request_data.get("n", 1) == 1
+
+    @staticmethod
+    def key_for(url: str, request_data: Dict) -> str:
+        """
+        Key For
+
+        Canonical hash of the endpoint URL and the request body (model, messages, parameters).
+
+        Args:
+            url (str): The request URL
+            request_data (Dict): The request JSON object
+
+        Returns:
+            str: The cache key
+        """
+        canonical = json.dumps({"url": url, "body": request_data}, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{CACHE_FILE_SUFFIX}")
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Get
+
+        Look up a cached response.
+
+        Args:
+            key (str): The cache key
+
+        Returns:
+            Optional[Dict]: {"status_code", "headers", "content"} or None on a miss or an expired entry
+        """
+        path = self.path_for(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if self.ttl_seconds is not None and time.time() - entry["stored_at"] > self.ttl_seconds:
+            self.remove(path)
+            return None
+
+        # Refresh the modification time so that eviction is least-recently-used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return {
+            "status_code": entry["status_code"],
+            "headers": entry["headers"],
+            "content": base64.b64decode(entry["content"]),
+        }
+
+    def put(self, key: str, status_code: int, headers: Dict[str, str], content: bytes) -> None:
+        """
+        Put
+
+        Store a response. The raw body is kept byte-for-byte so SSE streams replay exactly as received.
+
+        Args:
+            key (str): The cache key
+            status_code (int): The HTTP status code
+            headers (Dict[str, str]): The response headers
+            content (bytes): The decoded response body
+
+        Returns:
+            None
+        """
+        entry = {
+            "stored_at": time.time(),
+            "status_code": status_code,
+            "headers": {k: v for k, v in headers.items() if k.lower() not in UNCACHED_HEADERS},
+            "content": base64.b64encode(content).decode("ascii"),
+        }
+
+        # Write to a temporary file first so concurrent tokmon instances never read a partial entry
+        path = self.path_for(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        self.total_bytes += os.path.getsize(tmp_path) - self.size_of(path)
+        os.replace(tmp_path, path)
+
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Evict
+
+        Remove the least recently used entries until the cache fits in `max_bytes` (with some headroom).
+        Expired entries are removed lazily by `get`, and being the least recently used they are evicted first.
+        """
+        entries = sorted(self.scan())
+        total_bytes = sum(size for _, size, _ in entries)
+        target_bytes = self.max_bytes * EVICTION_TARGET_RATIO
+
+        for _, size, path in entries:
+            if total_bytes <= target_bytes:
+                break
+            self.remove(path)
+            total_bytes -= size
+
+        # Resync the estimate with the directory (other tokmon instances may share it)
+        self.total_bytes = total_bytes
+
+    def scan(self) -> List[Tuple[float, int, str]]:
+        """
+        (modification time, size, path) of every entry in the cache directory
+        """
+        entries = []
+        for dir_entry in os.scandir(self.cache_dir):
+            if not dir_entry.name.endswith(CACHE_FILE_SUFFIX):
+                continue
+            try:
+                stat = dir_entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        return entries
+
+    def size_of(self, path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    def remove(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+        except FileNotFoundError:
+            pass
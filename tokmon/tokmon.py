@@ -2,45 +2,54 @@ import asyncio
 import os
 import json
 import subprocess
-import typing
 import time
-import uuid
-from typing import List, Tuple, Dict, Callable, TypeVar, Optional
+from typing import List, Dict, Optional, Union
 
-import tiktoken
 from mitmproxy import http, options
 from mitmproxy.tools.dump import DumpMaster
 
-from tokmon.utils import find_available_port, count_tokens_in_json
+from tokmon.costcalculator import CostTracker
+from tokmon.live import LiveReporter
+from tokmon.recorder import UsageRecorder, RequestResponseHandler
+from tokmon.responsecache import ResponseCache
+from tokmon.utils import find_available_port, allow_hosts_for_targets
 
 PORT = find_available_port(7878)
 
-RequestResponseHandler = Callable[[str, Dict, Dict], None]
+CACHE_HIT_METADATA_KEY = "tokmon_cache_hit"
+CACHE_KEY_METADATA_KEY = "tokmon_cache_key"
+BUDGET_BLOCKED_METADATA_KEY = "tokmon_budget_blocked"
 
-class TokenMonitor:
+# Not retried by OpenAI's clients (unlike 429), so a blocked program fails fast
+BUDGET_EXCEEDED_STATUS_CODE = 402
+
+class TokenMonitor(UsageRecorder):
     def __init__(self,
-                 target_url: str,
+                 target_urls: Union[str, List[str]],
                  program_name: str,
                  *args: tuple,
                  verbose:bool = False,
-                 req_res_handler: RequestResponseHandler = None
+                 req_res_handler: RequestResponseHandler = None,
+                 response_cache: Optional[ResponseCache] = None,
+                 cost_tracker: Optional[CostTracker] = None,
+                 live_reporter: Optional[LiveReporter] = None
                 ):
+        super().__init__(target_urls, verbose=verbose, req_res_handler=req_res_handler, cost_tracker=cost_tracker)
+
         self.mitm: Optional[DumpMaster] = None
-        self.target_url = target_url
         self.program_name = program_name
         self.args = args
         self.process = None
         self.using_stream = False
-        self.verbose = verbose
-        self.history: List[Tuple[Dict, Dict]] = []
         self.current_request = None
-        self.req_res_handler = req_res_handler
-        self.conversation_id = str(uuid.uuid4())
+        self.response_cache = response_cache
+        self.live_reporter = live_reporter
+        self.blocked_requests = 0
 
     # Issue: https://github.com/yagil/tokmon/issues/4
     # 
     # def responseheaders(self, flow: http.HTTPFlow):
-    #     if self.target_url in flow.request.pretty_url:
+    #     if self.is_target(flow):
     #         content_type = flow.response.headers.get("Content-Type", "")
     #         if "text/event-stream" in content_type:
     #             flow.response.stream = True
@@ -51,11 +60,11 @@ class TokenMonitor:
     def response(self, flow: http.HTTPFlow):
         self.handle_response(flow)
 
-    def append_history(self, request: Dict, response: Dict):
-        self.history.append((request, response))
+    def is_target(self, flow: http.HTTPFlow) -> bool:
+        return self.target_matcher.match(flow.request.pretty_url) is not None
             
     def handle_request(self, flow: http.HTTPFlow):
-        if self.target_url not in flow.request.pretty_url:
+        if not self.is_target(flow):
             return
         
         try:
@@ -73,6 +82,12 @@ class TokenMonitor:
             
             self.using_stream = request_data["stream"] if "stream" in request_data else False
 
+            if self.response_cache is not None and ResponseCache.is_cacheable(request_data):
+                self.replay_cached_response(flow, request_data)
+
+            if flow.response is None and self.budget_exceeded():
+                self.block_request(flow)
+
         except json.JSONDecodeError:
             print("Failed to parse request data as JSON")
 
@@ -80,47 +95,67 @@ class TokenMonitor:
             print(f"Error handling request: {str(e)}")
 
     def handle_response(self, flow: http.HTTPFlow):
-        if not flow.request.url.startswith(self.target_url):
+        if not self.is_target(flow):
             return
-    
-        model = ""
-        content = ""
-        usage = None
-
-        if flow.response and flow.response.text is not None:
-            if self.using_stream:
-                model, content, usage = self.handle_stream_response(flow.response.text)
-            else:    
-                response_data = json.loads(flow.response.text)
-                model = response_data["model"]
-                content = response_data["choices"][0]["message"]["content"]
-                usage = response_data["usage"]
-        else:
-            raise Exception("No response data")
-        
-        request = self.current_request
-        
-        # The messages are sent to OpenAI in the order that it makes sense for the LLM to read them
-        # But we want to display them in the order that they were sent by the user (i.e., the reversed order)
-        request["messages"] = [x for x in reversed(request["messages"])]
-
-        response = {
-            "model": model,
-            "messages": [{"role": "assistant", "content": content}],
-            "usage": usage
-        }
 
-        # Add the request and response to the rolling history
-        self.append_history(request, response)
+        try:
+            if flow.metadata.get(BUDGET_BLOCKED_METADATA_KEY, False):
+                return
 
-        # Invoke the delegate callback for additional handling on the response object
-        if self.req_res_handler is not None:
-            self.req_res_handler(self.conversation_id, request, response)
+            if not flow.response or flow.response.text is None:
+                raise Exception("No response data")
 
-        self.current_request = None
+            cached = flow.metadata.get(CACHE_HIT_METADATA_KEY, False)
+            cache_key = flow.metadata.get(CACHE_KEY_METADATA_KEY)
+            if not cached and cache_key is not None and flow.response.status_code == 200:
+                self.response_cache.put(cache_key, flow.response.status_code, dict(flow.response.headers), flow.response.content)
+
+            self.record_exchange(self.current_request, flow.response.text, self.using_stream, cached=cached)
+        finally:
+            # Reset even if accounting failed, so the next request isn't reported as concurrent
+            self.current_request = None
+
+    def budget_exceeded(self) -> bool:
+        return self.cost_tracker is not None and self.cost_tracker.budget_exceeded()
+
+    def block_request(self, flow: http.HTTPFlow):
+        """
+        Answer the request with an error instead of forwarding it upstream, once the budget has been spent.
+        """
+        budget = self.cost_tracker.budget
+        if self.blocked_requests == 0:
+            print(f"[tokmon] Budget of ${budget:.6f} exceeded (${self.cost_tracker.total_cost:.6f} spent). Blocking further API requests.")
+        self.blocked_requests += 1
+
+        error = {
+            "error": {
+                "message": f"tokmon: budget of ${budget:.6f} exceeded",
+                "type": "tokmon_budget_exceeded",
+                "code": "budget_exceeded"
+            }
+        }
+        flow.response = http.Response.make(BUDGET_EXCEEDED_STATUS_CODE, json.dumps(error), {"Content-Type": "application/json"})
+        flow.metadata[BUDGET_BLOCKED_METADATA_KEY] = True
+
+    def replay_cached_response(self, flow: http.HTTPFlow, request_data: Dict):
+        """
+        Answer the request from the local cache instead of forwarding it upstream.
+        On a miss, remember the key so that `handle_response` can store the upstream response.
+        """
+        cache_key = ResponseCache.key_for(flow.request.pretty_url, request_data)
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is None:
+            flow.metadata[CACHE_KEY_METADATA_KEY] = cache_key
+            return
+
+        headers = dict(cached_response["headers"])
+        headers["x-tokmon-cache"] = "HIT"
+        # Setting a response in the request hook short-circuits the upstream round trip
+        flow.response = http.Response.make(cached_response["status_code"], cached_response["content"], headers)
+        flow.metadata[CACHE_HIT_METADATA_KEY] = True
 
         if self.verbose:
-            print(response)
+            print(f"Serving cached response for {flow.request.pretty_url} ({cache_key})")
 
     async def run_monitored_program(self) -> bool:
         env = os.environ.copy()
@@ -166,66 +201,11 @@ class TokenMonitor:
             
         return False
     
-    def encode(self, model, text):
-        """
-        Learn more: https://github.com/openai/tiktoken
-        """
-        tokenizer = tiktoken.encoding_for_model(model)
-        return tokenizer.encode(text)
-
-    def handle_stream_response(self, raw_messages: typing.List[str]):
-        """
-        When streaming, OpenAI's API doesn't return usage data.
-        To work around this, we use tiktoken directly.
-
-        See: https://community.openai.com/t/usage-info-in-api-responses/18862/11
-        """
-        
-        assert self.current_request is not None
-
-        model = None
-
-        completion_tokens = 0
-        completion_content = ""
-
-        # mitmproxy buffers the returned SSE chunks as one big string
-        for msg in raw_messages.split("\n"):
-            if msg.startswith("data:"):
-                try:
-                    msg = msg[5:]
-                    if "".join(msg.split()) == "[DONE]":
-                        break
-                    msg = json.loads(msg)
-                    model = msg["model"]
-                    
-                    choice = msg["choices"][0]
-                    if "delta" in choice:
-                        if "content" in choice["delta"]:
-                            tokens = choice["delta"]["content"]
-                            completion_content += tokens
-                            encoded_tokens = self.encode(model, tokens)
-                            completion_tokens += len(encoded_tokens)
-
-                except json.JSONDecodeError as e:
-                    print(f"\n\n ! ! Failed to parse response data as JSON {e} --- <{msg}> ! !\n\n")
-                except Exception as e:
-                    print(f"\n\n ! ! Failed to parse response data: {e} ! !\n\n")
-                    raise e
-        
-        encode_lambda = lambda text: self.encode(model, text)
-        prompt_tokens = count_tokens_in_json(encode_lambda, self.current_request)
-        total_tokens = prompt_tokens + completion_tokens
-        
-        # mimic the usage data returned by the API in the non streaming case
-        usage = {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": total_tokens
-        }
-        return model, completion_content, usage
-    
     async def start_monitoring(self):        
-        opts = options.Options(listen_host='0.0.0.0', listen_port=PORT)
+        # Only intercept TLS for the monitored API hosts; everything else is tunneled untouched
+        opts = options.Options(listen_host='0.0.0.0',
+                               listen_port=PORT,
+                               allow_hosts=allow_hosts_for_targets(self.target_urls))
         if self.verbose:
             print(f"Starting mitmproxy on port {PORT}...")
         self.mitm = DumpMaster(opts, with_termlog=False, with_dumper=False)
@@ -248,12 +228,17 @@ class TokenMonitor:
                     await asyncio.sleep(1)
             self.stop_monitoring()
 
-        await asyncio.gather(run_mitmproxy(), wait_subprocess())
+        # Writes live updates that were held back by the throttle, even if no further request completes
+        live_task = asyncio.ensure_future(self.live_reporter.run()) if self.live_reporter else None
+        try:
+            await asyncio.gather(run_mitmproxy(), wait_subprocess())
+        finally:
+            if live_task:
+                live_task.cancel()
     
     def stop_monitoring(self):
         if self.process:
             self.process.terminate()
-        self.mitm.shutdown()
+        if self.mitm:
+            self.mitm.shutdown()
 
-    def usage_summary(self):
-        return self.conversation_id, self.history
@@ -1,6 +1,8 @@
+import re
 import socket
 
-from typing import Callable, List, Any
+from typing import Callable, List, Any, Pattern
+from urllib.parse import urlsplit
 
 def find_available_port(start_port: int):
     """
@@ -32,4 +34,29 @@ def count_tokens_in_json(encode_fn: Callable[[str], List[str]], data: Any) -> in
         else:
             token_count += len(encode_fn( str(current) ) )
 
-    return token_count
\ No newline at end of file
+    return token_count
+
+def compile_target_matcher(target_urls: List[str]) -> Pattern[str]:
+    """
+    Build a single precompiled regex that matches any URL starting with one of the target base URLs.
+    """
+    alternatives = "|".join(re.escape(url) for url in target_urls)
+    return re.compile(f"^(?:{alternatives})", re.IGNORECASE)
+
+def allow_hosts_for_targets(target_urls: List[str]) -> List[str]:
+    """
+    Derive mitmproxy `allow_hosts` patterns from the target base URLs.
+    Connections to any other host are tunneled through the proxy without TLS interception.
+
+    mitmproxy matches these against bare hostnames (server address and SNI), so the port is left out;
+    the full URL, port included, is still checked by the target matcher.
+    """
+    patterns = []
+    for url in target_urls:
+        parts = urlsplit(url)
+        if not parts.hostname:
+            raise ValueError(f"Invalid target URL (missing scheme or host): {url}")
+        pattern = f"^{re.escape(parts.hostname)}$"
+        if pattern not in patterns:
+            patterns.append(pattern)
+    return patterns